@@ -45,23 +45,107 @@
 
 __version__ = '0.2.0'
 
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import functools
+import hashlib
+import heapq
+from itertools import chain
 import json
 import logging
+import math
+from operator import itemgetter
+import os
+import pickle
+import tempfile
+import time
+from urllib.parse import urlencode
 
 from owslib import fes
+from owslib.etree import etree
 from owslib.wfs import WebFeatureService
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
+
+try:
+    from cachecontrol import CacheControlAdapter
+    from cachecontrol.caches.file_cache import FileCache
+except ImportError:
+    CacheControlAdapter = None
+
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv
+    from pyarrow import ipc as pyarrow_ipc
+except ImportError:
+    pyarrow = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
 
 LOGGER = logging.getLogger(__name__)
 
+_CHUNK_SIZE = 64 * 1024
+
+_DEFAULT_TIMES = {
+    'begin': ' 00:00:00',
+    'end': ' 23:59:59'
+}
+
+_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_ADAPTERS = {}
+
+_GET_DATA_KWARGS = frozenset([
+    'bbox', 'temporal', 'filters', 'variables', 'only', 'sortby',
+    'sort_order', 'output_backend', 'as_dataframe'
+])
+
+
+class _ParseError(ValueError):
+    """Response payload could not be parsed (e.g. an OWS exception)"""
+
 
 class WoudcClient(object):
     """WOUDC Client"""
 
-    def __init__(self, url='https://geo.woudc.org/ows', timeout=30):
+    def __init__(self, url='https://geo.woudc.org/ows', timeout=30,
+                 cache_dir=None, max_workers=8, cache=True,
+                 cache_ttl=3600):
         """
         Initialize a WOUDC Client.
 
+        :param url: the URL of the WOUDC data service
+        :param timeout: time (in seconds) after which requests should timeout
+        :param cache_dir: directory in which to cache metadata,
+                          observations and HTTP responses (the latter
+                          requires CacheControl).  Default is the
+                          ``PYWOUDC_CACHE_DIR`` environment variable,
+                          if set, else no cache
+        :param max_workers: maximum number of pages of observations to
+                            download concurrently (default is 8)
+        :param cache: a boolean specifying whether to cache responses at
+                      all (default is True).  If False, `cache_dir` is
+                      ignored
+        :param cache_ttl: time (in seconds) for which downloaded metadata
+                          is reused within the session, and cached
+                          observations are reused (default is 3600)
+
         :returns: instance of pywoudc.WoudcClient
         """
 
@@ -77,19 +161,85 @@ class WoudcClient(object):
         self.outputformat = 'application/json; subtype=geojson'
         """The default outputformat when requesting WOUDC data"""
 
-        self.maxfeatures = 25000
+        self._maxfeatures = None
+
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+
+        self.max_workers = max_workers
+        """The maximum number of pages to download concurrently"""
+
+        if cache_dir is None:
+            cache_dir = os.environ.get('PYWOUDC_CACHE_DIR') or None
+
+        if not cache:
+            cache_ttl = 0
+            cache_dir = None
+
+        self.cache_ttl = cache_ttl
+        """Time (in seconds) for which metadata and observations are reused"""
+
+        self.cache_dir = cache_dir
+        """Directory in which to cache metadata, observations and responses"""
+
+        self._metadata = {}
+
+        self.session = _get_session(self.max_workers, cache_dir)
+        """HTTP session for WOUDC requests (its connection pool is shared
+        with other clients with the same settings)"""
+
+        # capabilities are only fetched on first use
+        self._server = None
+
+    @property
+    def server(self):
+        """The main WOUDC server"""
+
+        return self._get_server()
+
+    @property
+    def maxfeatures(self):
         """The default limit of records to return"""
 
+        if self._maxfeatures is None:
+            self._get_server()
+        return self._maxfeatures
+
+    @maxfeatures.setter
+    def maxfeatures(self, value):
+        self._maxfeatures = value
+
+    def _get_server(self):
+        """
+        Fetch and parse the WOUDC server capabilities (once)
+
+        :returns: `owslib.wfs.WebFeatureService` instance
+        """
+
+        if self._server is not None:
+            return self._server
+
         LOGGER.info('Contacting %s', self.url)
-        self.server = WebFeatureService(self.url, '1.1.0',
-                                        timeout=self.timeout)
-        """The main WOUDC server"""
+        capabilities = self.session.get(self.url, params={
+            'service': 'WFS',
+            'version': '1.1.0',
+            'request': 'GetCapabilities'
+        }, timeout=self.timeout)
+        capabilities.raise_for_status()
 
-        try:
-            mf = int(self.server.constraints['DefaultMaxFeatures'].values[0])
-            self.maxfeatures = mf
-        except AttributeError or KeyError:
-            LOGGER.info('Using default maxfeatures')
+        self._server = WebFeatureService(self.url, '1.1.0',
+                                         xml=capabilities.content,
+                                         timeout=self.timeout)
+
+        if self._maxfeatures is None:
+            self._maxfeatures = 25000
+            try:
+                constraint = self._server.constraints['DefaultMaxFeatures']
+                self._maxfeatures = int(constraint.values[0])
+            except (AttributeError, IndexError, KeyError, ValueError):
+                LOGGER.info('Using default maxfeatures')
+
+        return self._server
 
     def get_station_metadata(self, raw=False):
         """
@@ -127,12 +277,46 @@ class WoudcClient(object):
         LOGGER.info('Fetching contributor metadata')
         return self._get_metadata('contributors', raw)
 
+    def iter_features(self, typename):
+        """
+        Iterate over WOUDC features one page at a time, as each response
+        arrives (incrementally if ijson is installed), without assembling
+        the whole FeatureCollection
+
+        :param typename: the WOUDC typename (e.g. ``stations``)
+
+        :returns: generator of GeoJSON features
+        """
+
+        LOGGER.info('Iterating over %s features', typename)
+        query = self._get_feature_query(typename,
+                                        outputformat=self.outputformat)
+        startindex = 0
+
+        while True:
+            response = self._get_feature(query, stream=True,
+                                         startindex=startindex,
+                                         maxfeatures=self.maxfeatures)
+            count = 0
+            try:
+                for feature in _iter_features(
+                        response.iter_content(_CHUNK_SIZE),
+                        incremental=True):
+                    count += 1
+                    yield feature
+            finally:
+                response.close()
+
+            if count < self.maxfeatures:
+                return
+            startindex += count
+
     def get_data(self, typename, **kwargs):
         """
         Download WOUDC observations
 
         :param bbox: a list representing a bounding box spatial
-                     filter (`minx, miny, maxx, maxy`)
+                     filter (`minx, miny, maxx, maxy`) in degrees
         :param temporal: a list of two elements representing a time period
                          (start, end) which accepts the following types:
 
@@ -142,58 +326,85 @@ class WoudcClient(object):
                           - string datetime (e.g. ``2012-10-30 11:11:11``)
 
         :param filters: `dict` of key-value pairs of property names and
-                        values.  Constructs exclusive search
+                        values.  Constructs exclusive search.  A value
+                        may be a list of values, any of which match
         :param variables: a list of variables to return
-                          as part of the response (default returns all)
-        :param sort_property: a string representing the property on which
-                              to sort results (default ``instance_datetime``)
+                          as part of the response (default returns all).
+                          Requesting only the variables needed reduces
+                          the size of the response
+        :param only: alias of `variables`
+        :param sortby: a string representing the property on which
+                       to sort results (default is no sorting)
         :param sort_order: a string representing sort order of response
                            (``asc`` or ``desc``).  Default is ``asc``.
-                           Applied if `sort_property` is specified
+                           Applied if `sortby` is specified
+        :param output_backend: a string representing the response encoding
+                               (``geojson`` or ``arrow``).  ``arrow``
+                               requests CSV and parses it with pyarrow.
+                               Default is ``geojson``
+        :param as_dataframe: a boolean to return a
+                             :py:class:`pandas.DataFrame` with one column
+                             per property (plus ``geometry``) instead.
+                             Default is ``False``
 
-        :returns: list of WOUDC observations GeoJSON payload
+        :returns: list of WOUDC observations GeoJSON payload,
+                  :py:class:`pyarrow.Table` if `output_backend` is
+                  ``arrow``, or :py:class:`pandas.DataFrame` if
+                  `as_dataframe` is ``True``
         """
 
         constraints = []
-        filters = []
-        variables = '*'
         filter_string = None
-        bbox = None
-        temporal = None
-        sort_property = None
-        sort_order = 'asc'
-        startindex = 0
-        features = None
-        feature_collection = None
         sort_descending = False
 
         LOGGER.info('Downloading dataset %s', typename)
 
         LOGGER.debug('Assembling query parameters')
-        for key, value in kwargs.items():
-            if key == 'bbox':
-                bbox = value
-            if key == 'temporal':
-                temporal = value
-            if key == 'filters':
-                filters = value
-            if key == 'variables':
-                variables = value
-            if key == 'sortby':
-                sort_property = value
-            if key == 'sort_order':
-                sort_order = value
+        unknown = set(kwargs) - _GET_DATA_KWARGS
+        if unknown:
+            msg = 'Unexpected keyword argument(s): %s' % ', '.join(
+                sorted(unknown))
+            raise TypeError(msg)
+
+        bbox = kwargs.get('bbox')
+        temporal = kwargs.get('temporal')
+        filters = kwargs.get('filters')
+        variables = kwargs.get('variables', kwargs.get('only', '*'))
+        sort_property = kwargs.get('sortby')
+        sort_order = kwargs.get('sort_order', 'asc')
+        output_backend = kwargs.get('output_backend', 'geojson')
+        as_dataframe = kwargs.get('as_dataframe', False)
 
         LOGGER.debug('Assembling constraints')
         if filters:
             for key, value in filters.items():
-                constraints.append(fes.PropertyIsEqualTo(key, value))
+                if not isinstance(value, (list, tuple)):
+                    constraints.append(fes.PropertyIsEqualTo(key, str(value)))
+                    continue
+
+                if not value:
+                    msg = 'filter values for %s must not be empty' % key
+                    raise ValueError(msg)
+
+                values = [fes.PropertyIsEqualTo(key, str(v)) for v in value]
+                if len(values) == 1:
+                    constraints.append(values[0])
+                else:
+                    constraints.append(fes.Or(values))
         if bbox is not None:
-            if not isinstance(bbox, list) or len(bbox) != 4:
-                raise ValueError('bbox must be list of minx, miny, maxx, maxy')
+            msg = 'bbox must be list of minx, miny, maxx, maxy'
+            if isinstance(bbox, str):
+                raise ValueError(msg)
+            try:
+                minx, miny, maxx, maxy = map(float, bbox)
+            except (TypeError, ValueError):
+                raise ValueError(msg)
+            if not (-180 <= minx <= maxx <= 180 and
+                    -90 <= miny <= maxy <= 90):
+                raise ValueError('bbox must be within -180, -90, 180, 90')
 
             LOGGER.debug('Setting spatial constraint')
-            constraints.append(fes.BBox(bbox))
+            constraints.append(fes.BBox([minx, miny, maxx, maxy]))
 
         if temporal is not None:
             if not isinstance(temporal, list) or len(temporal) != 2:
@@ -213,10 +424,27 @@ class WoudcClient(object):
             if sort_order == 'desc':
                 sort_descending = True
 
+        if 'variables' in kwargs and 'only' in kwargs:
+            raise ValueError('variables and only are mutually exclusive')
+
         if variables != '*':
             if not isinstance(variables, list):
                 raise ValueError('variables must be list')
 
+            if sort_property is not None and sort_property not in variables:
+                LOGGER.debug('Adding %s to variables for sorting',
+                             sort_property)
+                variables = variables + [sort_property]
+
+        if output_backend not in ['geojson', 'arrow']:
+            raise ValueError('output_backend must be geojson or arrow')
+
+        if output_backend == 'arrow' and pyarrow is None:
+            raise ImportError('pyarrow is required for arrow output')
+
+        if as_dataframe and pandas is None:
+            raise ImportError('pandas is required for dataframe output')
+
         if constraints:
             LOGGER.debug('Combining constraints')
             flt = fes.FilterRequest()
@@ -235,91 +463,671 @@ class WoudcClient(object):
         LOGGER.info('temporal: %r', temporal)
         LOGGER.info('attribute queries: %r', filters)
 
-        # page download and assemble single list of JSON features
-        while True:
-            LOGGER.debug('Fetching features %d - %d',
-                         startindex, startindex + self.maxfeatures)
-
-            payload = self.server.getfeature(
-                typename=typename,
-                startindex=startindex,
-                propertyname=variables,
-                maxfeatures=self.maxfeatures,
-                filter=filter_string,
-                outputFormat=self.outputformat).read()
+        cache_file = None
+        if self.cache_dir is not None and self.cache_ttl > 0:
+            key = repr((self.url, self.outputformat, typename,
+                        output_backend, variables, filter_string,
+                        sort_property, sort_descending))
+            cache_file = os.path.join(
+                self.cache_dir, 'data', '%s.%s' % (hashlib.sha1(
+                    key.encode('utf-8')).hexdigest(),
+                    'arrow' if output_backend == 'arrow' else 'json'))
 
-            LOGGER.debug('Processing response')
-            if payload.isspace():
-                LOGGER.debug('Empty response. Exiting')
-                break
+        data = None
+        payload = _read_cache(cache_file, self.cache_ttl)
 
+        if payload is not None:
             try:
-                features = json.loads(payload)
+                data = _load_observations(payload, output_backend)
+                LOGGER.info('Using cached observations from %s', cache_file)
             except ValueError:
-                msg = 'Query produced no results'
-                LOGGER.info(msg)
+                LOGGER.warning('Ignoring invalid cache file %s', cache_file)
+
+        if data is None:
+            if output_backend == 'arrow':
+                data = self._get_table(typename, variables, filter_string,
+                                       sort_property, sort_descending)
+            else:
+                data = self._get_collection(typename, variables,
+                                            filter_string, sort_property,
+                                            sort_descending)
+
+            if data is None:
                 return None
 
-            len_features = len(features['features'])
+            if cache_file is not None:
+                LOGGER.debug('Caching observations to %s', cache_file)
+                _write_cache(cache_file, _dump_observations(data))
 
-            LOGGER.debug('Found %d features', len_features)
+        if not as_dataframe:
+            return data
 
-            if feature_collection is None:
-                feature_collection = features
-            else:
-                feature_collection['features'].extend(features['features'])
+        LOGGER.debug('Building dataframe')
+        if output_backend == 'arrow':
+            return data.to_pandas()
+
+        features = data['features']
+        dataframe = pandas.DataFrame.from_records(
+            [f['properties'] for f in features])
+        dataframe['geometry'] = [f.get('geometry') for f in features]
+        return dataframe
+
+    def _get_collection(self, typename, variables, filter_string,
+                        sort_property=None, sort_descending=False):
+        """download WOUDC observations as a GeoJSON FeatureCollection"""
+
+        def parse_page(chunks):
+            page = list(_iter_features(chunks))
+            if sort_property is not None:
+                # sort (cheap if the server already has) on sort keys
+                # extracted once, as (key, feature) pairs for merging
+                keys = [f['properties'][sort_property] for f in page]
+                order = sorted(range(len(page)), key=keys.__getitem__,
+                               reverse=sort_descending)
+                page = [(keys[i], page[i]) for i in order]
+            return page
 
-            if len_features < self.maxfeatures:
-                break
+        # page download and assemble single list of JSON features
+        feature_collection = {
+            'type': 'FeatureCollection',
+            'features': []
+        }
+
+        try:
+            pages = self._get_pages(
+                typename, parse_page, propertyname=variables,
+                filter_string=filter_string, outputformat=self.outputformat,
+                sortby=_sortby(sort_property, sort_descending))
+        except _ParseError:
+            msg = 'Query produced no results'
+            LOGGER.info(msg)
+            return None
 
-            startindex = startindex + self.maxfeatures
+        if sort_property is not None:
+            if _pages_in_order(pages, sort_descending):
+                LOGGER.debug('Pages sorted by server')
+                merged = chain.from_iterable(pages)
+            else:
+                LOGGER.info('Merging sorted pages by %s', sort_property)
+                merged = heapq.merge(*pages, key=itemgetter(0),
+                                     reverse=sort_descending)
+            feature_collection['features'] = list(map(itemgetter(1), merged))
+        else:
+            feature_collection['features'] = list(
+                chain.from_iterable(pages))
 
         len_feature_collection = len(feature_collection['features'])
         LOGGER.info('Found %d total features', len_feature_collection)
 
+        return feature_collection
+
+    def _get_table(self, typename, variables, filter_string,
+                   sort_property=None, sort_descending=False):
+        """download WOUDC observations as CSV into a pyarrow Table"""
+
+        convert_options = None
+        read_options = pyarrow_csv.ReadOptions(block_size=8 << 20)
+
+        def read_csv(chunks):
+            nonlocal convert_options
+
+            payload = b''.join(chunks)
+            if not payload.strip():
+                return None
+            if payload.lstrip().startswith(b'<'):
+                # XML (e.g. an OWS ExceptionReport) parses as valid CSV
+                raise _ParseError('Response is not CSV')
+
+            table = pyarrow_csv.read_csv(pyarrow.BufferReader(payload),
+                                         read_options=read_options,
+                                         convert_options=convert_options)
+
+            if convert_options is None:
+                # keep column types of the first page for subsequent pages
+                convert_options = pyarrow_csv.ConvertOptions(
+                    column_types=table.schema)
+
+            return table
+
+        try:
+            tables = self._get_pages(typename, read_csv,
+                                     propertyname=variables,
+                                     filter_string=filter_string,
+                                     outputformat='csv',
+                                     sortby=_sortby(sort_property,
+                                                    sort_descending))
+        except (pyarrow.ArrowInvalid, _ParseError):
+            msg = 'Query produced no results'
+            LOGGER.info(msg)
+            return None
+
+        if not tables:
+            LOGGER.info('Query produced no results')
+            return None
+
+        table = pyarrow.concat_tables(tables)
+        LOGGER.info('Found %d total features', table.num_rows)
+
         if sort_property is not None:
             LOGGER.info('Sorting response by %s', sort_property)
-            feature_collection['features'].sort(
-                key=lambda e: e['properties'][sort_property],
-                reverse=sort_descending)
+            order = 'descending' if sort_descending else 'ascending'
+            table = table.sort_by([(sort_property, order)])
 
-        return feature_collection
+        return table
+
+    def _get_pages(self, typename, parse, **kwargs):
+        """
+        page download of WOUDC observations.  The first page is fetched
+        alone; if it is full, the total number of matching features is
+        requested and the remaining pages are fetched concurrently
+
+        :param typename: typename to query
+        :param parse: function to parse a response (iterable of bytes)
+                      into a page (any sized object), or `None` if the
+                      response is empty
+        :param kwargs: keyword arguments passed to `_get_feature_query`
+
+        :returns: list of pages, in feature order
+        """
+
+        # the query (including the filter) is encoded once for all pages
+        query = self._get_feature_query(typename, **kwargs)
+
+        def get_page(startindex):
+            LOGGER.debug('Fetching features %d - %d',
+                         startindex, startindex + self.maxfeatures)
+
+            response = self._get_feature(query, stream=True,
+                                         startindex=startindex,
+                                         maxfeatures=self.maxfeatures)
+
+            LOGGER.debug('Processing response')
+            try:
+                # decompressed (gzip/deflate) chunks, as they arrive
+                page = parse(response.iter_content(_CHUNK_SIZE))
+            finally:
+                response.close()
+
+            if page is None:
+                LOGGER.debug('Empty response')
+                return None
+
+            LOGGER.debug('Found %d features', len(page))
+            return page
+
+        page = get_page(0)
+        if page is None:
+            return []
+
+        pages = [page]
+        if len(page) < self.maxfeatures:
+            return pages
+
+        total = self._get_hits(typename, kwargs.get('filter_string'))
+
+        if total is None:
+            LOGGER.debug('Hit count unavailable; paging sequentially')
+            startindex = self.maxfeatures
+            while True:
+                page = get_page(startindex)
+                if page is None:
+                    break
+                pages.append(page)
+                if len(page) < self.maxfeatures:
+                    break
+                startindex = startindex + self.maxfeatures
+            return pages
+
+        num_pages = int(math.ceil(total / float(self.maxfeatures)))
+        LOGGER.info('Fetching %d features in %d pages', total, num_pages)
+        if num_pages < 2:
+            return pages
+
+        startindexes = range(self.maxfeatures, total, self.maxfeatures)
+        max_workers = min(self.max_workers, num_pages - 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for count, page in enumerate(
+                    executor.map(get_page, startindexes), 2):
+                LOGGER.debug('Fetched page %d of %d', count, num_pages)
+                if page is not None:
+                    pages.append(page)
+
+        return pages
+
+    def _get_hits(self, typename, filter_string=None):
+        """
+        get the number of features matching a query
+
+        :returns: `int` of number of features, or `None` if the server
+                  does not report a count (or rejects the request)
+        """
+
+        LOGGER.debug('Fetching number of matching features')
+        try:
+            payload = self._get_feature(self._get_feature_query(
+                typename, filter_string=filter_string, resulttype='hits'))
+        except requests.exceptions.RequestException as err:
+            LOGGER.debug('Hits request failed: %s', err)
+            return None
+
+        try:
+            root = etree.fromstring(payload)
+            hits = root.get('numberOfFeatures', root.get('numberMatched'))
+            return int(hits)
+        except (etree.XMLSyntaxError, TypeError, ValueError):
+            LOGGER.debug('Could not determine number of features')
+            return None
+
+    def _get_feature_query(self, typename, propertyname='*',
+                           filter_string=None, outputformat=None,
+                           sortby=None, resulttype=None):
+        """
+        build a WFS GetFeature query
+
+        :returns: URL encoded query string
+        """
+
+        if isinstance(propertyname, list):
+            propertyname = ','.join(propertyname)
+
+        params = {
+            'service': 'WFS',
+            'version': '1.1.0',
+            'request': 'GetFeature',
+            'typename': typename,
+            'propertyname': propertyname
+        }
+
+        if filter_string is not None:
+            params['filter'] = filter_string
+        if outputformat is not None:
+            params['outputFormat'] = outputformat
+        if sortby is not None:
+            params['sortBy'] = sortby
+        if resulttype is not None:
+            params['resultType'] = resulttype
+
+        return urlencode(params)
+
+    def _get_feature(self, query, stream=False, **kwargs):
+        """
+        issue a WFS GetFeature request over the client HTTP session
+
+        :param query: URL encoded query string (from `_get_feature_query`)
+        :param stream: whether to return the response unread, for
+                       streaming its body (default is False)
+        :param kwargs: additional request parameters (e.g. `startindex`)
+
+        :returns: response payload (bytes), or
+                  :py:class:`requests.Response` if `stream` is True
+        """
+
+        if kwargs:
+            query = '%s&%s' % (query, urlencode(kwargs))
+
+        response = self.session.get(self.url, params=query, stream=stream,
+                                    timeout=self.timeout)
+        response.raise_for_status()
+
+        if stream:
+            return response
+
+        return response.content
 
     def _get_metadata(self, typename, raw=False):
         """generic design pattern to download WOUDC metadata"""
 
-        LOGGER.debug('Fetching data from server')
-        features = self.server.getfeature(typename=typename,
-                                          outputFormat=self.outputformat)
+        cached = self._metadata.get(typename)
+
+        if cached is not None and time.time() - cached[0] < self.cache_ttl:
+            LOGGER.debug('Using cached %s metadata', typename)
+        else:
+            cached = (time.time(),) + self._fetch_metadata(typename)
+            self._metadata[typename] = cached
 
         LOGGER.debug('Processing response')
         if raw:
             LOGGER.info('Emitting raw GeoJSON response')
-            return features.read()
+            return cached[1].decode('utf-8')
         LOGGER.info('Emitting GeoJSON features as list')
-        return json.loads(features.read().decode('utf-8'))
+        # unpickling is faster than parsing JSON, and returns a new copy
+        return pickle.loads(cached[2])
+
+    def _fetch_metadata(self, typename):
+        """
+        download WOUDC metadata, revalidating against the copy
+        in `cache_dir` (if set) by ETag
+
+        :returns: `tuple` of response payload (bytes) and pickled
+                  GeoJSON payload
+        """
+
+        filename = None
+        stored = None
+        headers = {}
+
+        if self.cache_dir is not None:
+            # one directory per server, so clients share no ETags
+            filename = os.path.join(
+                self.cache_dir, 'metadata',
+                hashlib.sha1(self.url.encode('utf-8')).hexdigest(),
+                '%s.json' % typename)
+            # ETag line, then the GeoJSON payload as received
+            contents = _read_cache(filename)
+            if contents is not None:
+                etag, _, payload = contents.partition(b'\n')
+                try:
+                    data = pickle.dumps(_json_loads(payload),
+                                        pickle.HIGHEST_PROTOCOL)
+                    stored = (etag.decode('utf-8'), payload, data)
+                    headers['If-None-Match'] = stored[0]
+                except ValueError:
+                    LOGGER.warning('Ignoring invalid cache file %s',
+                                   filename)
+
+        LOGGER.debug('Fetching data from server')
+        response = self.session.get(self.url, params=self._get_feature_query(
+            typename, outputformat=self.outputformat), headers=headers,
+            timeout=self.timeout)
+        response.raise_for_status()
+
+        etag = response.headers.get('ETag')
+
+        if stored is not None and (response.status_code == 304 or
+                                   etag == stored[0]):
+            LOGGER.debug('%s metadata not modified', typename)
+            return stored[1:]
+
+        payload = response.content
+        data = pickle.dumps(_json_loads(payload), pickle.HIGHEST_PROTOCOL)
+
+        if filename is not None and etag is not None:
+            LOGGER.debug('Caching %s metadata to %s', typename, filename)
+            contents = b'\n'.join([etag.encode('utf-8'), payload])
+            _write_cache(filename, contents)
+
+        return payload, data
+
+
+def _get_session(max_workers, cache_dir=None):
+    """
+    Utility function (private) to create an HTTP session for a client.
+    Sessions (headers, auth, cookies) are per client, but their adapter
+    (connection pool) is shared by all clients with the same settings,
+    so that instances reuse kept-alive connections (and TLS handshakes)
+    to the WOUDC server
+
+    :param max_workers: number of connections to keep per host
+    :param cache_dir: directory in which to cache HTTP responses
+                      (requires CacheControl)
+
+    :returns: `requests.Session` instance
+    """
+
+    if cache_dir is not None and CacheControlAdapter is None:
+        LOGGER.warning('CacheControl not installed; '
+                       'not caching HTTP responses')
+        cache_dir = None
+
+    key = (max_workers, cache_dir)
+    adapter = _ADAPTERS.get(key)
+
+    if adapter is None:
+        adapter = _get_adapter(max_workers, cache_dir)
+        adapter = _ADAPTERS.setdefault(key, adapter)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def _get_adapter(max_workers, cache_dir=None):
+    """
+    Utility function (private) to create a pooled HTTP adapter
+
+    :param max_workers: number of connections to keep per host
+    :param cache_dir: directory in which to cache HTTP responses
+                      (CacheControl must be installed)
+
+    :returns: `requests.adapters.HTTPAdapter` instance
+    """
+
+    # connections are kept alive and shared by concurrent page
+    # downloads; transient server errors are retried with backoff
+    pool_kwargs = {
+        'pool_connections': max_workers,
+        'pool_maxsize': max_workers,
+        'max_retries': Retry(total=3, backoff_factor=0.5,
+                             status_forcelist=[429, 502, 503, 504])
+    }
+
+    if cache_dir is not None:
+        try:
+            # FileCache needs filelock (CacheControl[filecache])
+            cache = FileCache(cache_dir)
+        except ImportError as err:
+            LOGGER.warning('Not caching HTTP responses: %s', err)
+        else:
+            LOGGER.debug('Caching HTTP responses in %s', cache_dir)
+            return CacheControlAdapter(cache=cache, **pool_kwargs)
+
+    return HTTPAdapter(**pool_kwargs)
+
+
+def _read_cache(filename, max_age=None):
+    """
+    Utility function (private) to read a file written by `_write_cache`,
+    if younger than `max_age` seconds (if set)
+
+    :returns: `bytes` of file contents, or `None` if missing or expired
+    """
+
+    if filename is None:
+        return None
+
+    try:
+        if (max_age is not None and
+                time.time() - os.path.getmtime(filename) >= max_age):
+            return None
+        with open(filename, 'rb') as fh:
+            return fh.read()
+    except (IOError, OSError):
+        return None
+
+
+def _write_cache(filename, payload):
+    """Utility function (private) to atomically write a cache file"""
+
+    dirname = os.path.dirname(filename)
+
+    try:
+        _makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(payload)
+        os.replace(tmpname, filename)
+    except (IOError, OSError) as err:
+        LOGGER.warning('Could not write cache file %s: %s', filename, err)
+
+
+def _makedirs(dirname):
+    """
+    Utility function (private) to create a directory and its parents,
+    readable and writable by the current user only
+    """
+
+    if os.path.isdir(dirname):
+        return
+
+    _makedirs(os.path.dirname(dirname))
+
+    try:
+        os.mkdir(dirname, 0o700)
+    except FileExistsError:
+        pass
+
+
+def _dump_observations(data):
+    """
+    Utility function (private) to serialize observations for caching:
+    GeoJSON as JSON, :py:class:`pyarrow.Table` as Arrow IPC
+
+    :returns: `bytes` of serialized observations
+    """
+
+    if isinstance(data, dict):
+        if orjson is not None:
+            return orjson.dumps(data)
+        return json.dumps(data).encode('utf-8')
+
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow_ipc.new_file(sink, data.schema) as writer:
+        writer.write_table(data)
+    return sink.getvalue().to_pybytes()
+
+
+def _load_observations(payload, output_backend):
+    """
+    Utility function (private) to deserialize cached observations
+    (from `_dump_observations`)
+
+    :returns: GeoJSON `dict`, or :py:class:`pyarrow.Table` if
+              `output_backend` is ``arrow``
+    """
+
+    if output_backend == 'arrow':
+        return pyarrow_ipc.open_file(pyarrow.BufferReader(payload)).read_all()
+
+    return _json_loads(payload)
+
+
+def _pages_in_order(pages, sort_descending=False):
+    """
+    Utility function (private) to test whether sorted pages of
+    (key, feature) pairs follow one another in order (i.e. the server
+    has sorted the whole result)
+    """
+
+    bounds = [(page[0][0], page[-1][0]) for page in pages if page]
+
+    for (_, last), (first, _) in zip(bounds, bounds[1:]):
+        if (first > last) if sort_descending else (first < last):
+            return False
+
+    return True
+
+
+def _sortby(sort_property, sort_descending=False):
+    """Utility function (private) to build a WFS sortBy parameter"""
+
+    if sort_property is None:
+        return None
+
+    return '%s %s' % (sort_property, 'D' if sort_descending else 'A')
+
+
+def _iter_features(chunks, incremental=False):
+    """
+    Utility function (private) to iterate over GeoJSON features.
+    Responses are parsed with orjson if available, else incrementally
+    as chunks arrive with ijson if available, else with json
+
+    :param chunks: GeoJSON FeatureCollection (iterable of bytes)
+    :param incremental: a boolean to prefer ijson over orjson, so that
+                        features are yielded before the response ends
+    :returns: generator of GeoJSON features (none if the response
+              is blank)
+    """
+
+    if ijson is None or (orjson is not None and not incremental):
+        payload = b''.join(chunks)
+        if not payload.strip():
+            return
+        try:
+            features = _json_loads(payload)['features']
+        except ValueError as err:
+            raise _ParseError(err)
+        for feature in features:
+            yield feature
+        return
+
+    blank = True
+    features = ijson.sendable_list()
+    parser = ijson.items_coro(features, 'features.item', use_float=True)
+
+    try:
+        for chunk in chunks:
+            if blank and not chunk.strip():
+                continue
+            blank = False
+            parser.send(chunk)
+            for feature in features:
+                yield feature
+            del features[:]
+        if not blank:
+            parser.close()
+    except ijson.JSONError as err:
+        raise _ParseError(err)
+
+    for feature in features:
+        yield feature
 
 
 def date2string(dateval, direction='begin'):
     """Utility function (private)"""
 
-    date_as_string = None
-
-    if direction == 'begin':
-        default_time = '00:00:00'
-    elif direction == 'end':
-        default_time = '23:59:59'
-    else:
+    if direction not in _DEFAULT_TIMES:
         raise ValueError('direction value must be begin or end')
 
-    if isinstance(dateval, str):
-        if len(dateval) == 10:  # date
-            date_as_string = '%s %s' % (dateval, default_time)
-        elif len(dateval) > 10:  # datetime
-            date_as_string = dateval
-    elif isinstance(dateval, datetime.datetime):
-        date_as_string = dateval.strftime('%Y-%m-%d %H:%M:%S')
-    elif isinstance(dateval, datetime.date):
-        date_as_string = '%s %s' % (dateval.strftime('%Y-%m-%d'), default_time)
-
-    return date_as_string
+    if getattr(dateval, 'tzinfo', None) is not None:
+        # aware datetimes compare equal across time zones, but are
+        # formatted in their own time zone: do not cache them
+        return _date2string(dateval, direction)
+
+    try:
+        return _cached_date2string(dateval, direction)
+    except TypeError:  # unhashable value
+        return _date2string(dateval, direction)
+
+
+@functools.singledispatch
+def _date2string(dateval, direction):
+    """Utility function (private) for unsupported date types"""
+
+    return None
+
+
+@_date2string.register(str)
+def _str2string(dateval, direction):
+    """Utility function (private) for date and datetime strings"""
+
+    if len(dateval) == 10:  # date
+        return dateval + _DEFAULT_TIMES[direction]
+    elif len(dateval) > 10:  # datetime
+        return dateval
+
+    return None
+
+
+@_date2string.register(datetime.datetime)
+def _datetime2string(dateval, direction):
+    """Utility function (private) for datetime.datetime"""
+
+    return format(dateval, _DATETIME_FORMAT)
+
+
+# datetime.datetime subclasses datetime.date: dispatch picks the above
+@_date2string.register(datetime.date)
+def _date_only2string(dateval, direction):
+    """Utility function (private) for datetime.date"""
+
+    # constant time of day: format the date fields without strftime
+    return '%04d-%02d-%02d%s' % (dateval.year, dateval.month, dateval.day,
+                                 _DEFAULT_TIMES[direction])
+
+
+# the same query window is typically converted many times
+_cached_date2string = functools.lru_cache(maxsize=1024,
+                                          typed=True)(_date2string)
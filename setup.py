@@ -112,6 +112,7 @@ setup(
     maintainer_email=EMAIL,
     url=URL,
     install_requires=INSTALL_REQUIRES,
+    python_requires='>=3.5',
     packages=find_packages('.'),
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -121,6 +122,7 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
         'Topic :: Scientific/Engineering :: Atmospheric Science',
         'Topic :: Scientific/Engineering :: GIS'
     ],
@@ -43,24 +43,152 @@
 #
 # =================================================================
 
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from unittest import mock
+from urllib.parse import parse_qsl
 
 from owslib.feature.wfs110 import WebFeatureService_1_1_0
+import requests
 
-from pywoudc import WoudcClient, date2string
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+import pywoudc
+from pywoudc import (WoudcClient, date2string, _iter_features,
+                     _pages_in_order, _sortby)
+
+# v is a permutation of n, so that sorting by v reorders features
+FEATURES = [{
+    'type': 'Feature',
+    'id': str(n),
+    'geometry': {'type': 'Point', 'coordinates': [n, n]},
+    'properties': {'n': n, 'v': (n * 7) % 23}
+} for n in range(23)]
+
+
+class StubResponse(object):
+    """Minimal stand-in for requests.Response"""
+
+    def __init__(self, content=b'', status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                '%d Error' % self.status_code, response=self)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class StubSession(object):
+    """Minimal stand-in for requests.Session serving WFS GetFeature"""
+
+    def __init__(self, features=FEATURES, hits=True, sort=False,
+                 etag=None, exception=False):
+        self.features = features
+        self.exception = exception
+        self.hits = hits
+        self.sort = sort
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        query = dict(parse_qsl(params))
+        self.requests.append((url, query, headers or {}))
+
+        if query.get('resultType') == 'hits':
+            if self.hits == 'error':
+                return StubResponse(b'<ExceptionReport/>', status_code=400)
+            if not self.hits:
+                return StubResponse(b'<ExceptionReport/>')
+            return StubResponse(
+                b'<wfs:FeatureCollection xmlns:wfs='
+                b'"http://www.opengis.net/wfs" numberOfFeatures="%d"/>' %
+                len(self.features))
+
+        if self.exception:
+            return StubResponse(
+                b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                b'<ows:ExceptionReport xmlns:ows='
+                b'"http://www.opengis.net/ows" version="1.0.0">'
+                b'<ows:Exception exceptionCode="InvalidParameterValue"/>'
+                b'</ows:ExceptionReport>')
+
+        if self.etag is not None:
+            if (headers or {}).get('If-None-Match') == self.etag:
+                return StubResponse(status_code=304,
+                                    headers={'ETag': self.etag})
+
+        features = self.features
+        if self.sort and 'sortBy' in query:
+            name, order = query['sortBy'].split()
+            features = sorted(features, key=lambda f: f['properties'][name],
+                              reverse=order == 'D')
+
+        start = int(query.get('startindex', 0))
+        end = start + int(query.get('maxfeatures', len(features)))
+        features = features[start:end]
+
+        if query.get('outputFormat') == 'csv':
+            rows = ['%(n)d,%(v)d' % f['properties'] for f in features]
+            return StubResponse('\n'.join(['n,v'] + rows).encode('utf-8'))
+
+        return StubResponse(json.dumps({
+            'type': 'FeatureCollection',
+            'features': features
+        }).encode('utf-8'), headers={'ETag': self.etag})
+
+    def get_features(self):
+        """GetFeature (non-hits) requests issued"""
+
+        return [query for url, query, headers in self.requests
+                if query.get('resultType') != 'hits']
+
+
+def stub_client(session, maxfeatures=5, **kwargs):
+    """WoudcClient served by a stub session (no network access)"""
+
+    kwargs.setdefault('cache', False)
+    client = WoudcClient(**kwargs)
+    client.session = session
+    client.maxfeatures = maxfeatures
+    return client
 
 
 class WoudcClientTest(unittest.TestCase):
     """Test suite for package pywoudc.WoudcClient"""
 
-    def setUp(self):
-        """bootstrap"""
+    @classmethod
+    def setUpClass(cls):
+        """bootstrap (once, shared by all tests)"""
 
-        self.client = WoudcClient()
+        cls.client = WoudcClient()
 
-    def tearDown(self):
+    @classmethod
+    def tearDownClass(cls):
         """destroy"""
+
+        # the connection pool is shared with other clients: keep it open
         pass
 
     def test_smoke_test(self):
@@ -82,62 +210,376 @@ class WoudcClientTest(unittest.TestCase):
         self.assertEqual(self.client.timeout, 30,
                          'Expected specific default timeout')
 
-        self.assertTrue(isinstance(self.client.server,
-                                   WebFeatureService_1_1_0),
-                        'Expected specific instance')
+        self.assertEqual(self.client.max_workers, 8,
+                         'Expected specific default max_workers')
+
+        self.assertEqual(self.client.cache_ttl, 3600,
+                         'Expected specific default cache_ttl')
+
+        self.assertIsNone(self.client.cache_dir,
+                          'Expected no default cache_dir')
+
+        self.assertIsInstance(self.client.server, WebFeatureService_1_1_0,
+                              'Expected specific instance')
 
+    @unittest.skipUnless('WOUDC_LIVE' in os.environ,
+                         'full metadata download (set WOUDC_LIVE)')
     def test_get_metadata(self):
         """test get various requests for metadata"""
 
-        for typename in ['stations', 'contributors']:
-            data = self.client._get_metadata(typename)
+        typenames = ['stations', 'contributors']
 
-            self.assertTrue(isinstance(data, dict),
-                            'Expected specific instance')
+        # independent downloads: overlap them on the shared session
+        with ThreadPoolExecutor(max_workers=len(typenames)) as executor:
+            results = list(executor.map(self.client._get_metadata,
+                                        typenames))
 
-            self.assertTrue('type' in data,
-                            'Expected GeoJSON header')
+        for typename, data in zip(typenames, results):
+
+            self.assertIsInstance(data, dict, 'Expected specific instance')
+
+            self.assertIn('type', data, 'Expected GeoJSON header')
 
             self.assertEqual(data['type'], 'FeatureCollection',
                              'Expected GeoJSON header')
 
-            self.assertTrue('features' in data,
-                            'Expected GeoJSON header')
+            self.assertIn('features', data, 'Expected GeoJSON header')
 
-            self.assertTrue(len(data['features']) > 0,
-                            'Expected non-empty %s list' % typename)
+            self.assertGreater(len(data['features']), 0,
+                               'Expected non-empty %s list' % typename)
 
             raw_data = self.client._get_metadata(typename, raw=True)
 
-            self.assertTrue(isinstance(raw_data, str),
-                            'Expected specific instance')
+            self.assertIsInstance(raw_data, str, 'Expected specific instance')
 
-            self.assertTrue('"type": "FeatureCollection"' in raw_data,
+            # GeoJSON header leads the payload: only check its head
+            head = ''.join(raw_data[:64].split())
+            self.assertTrue(head.startswith('{"type":"FeatureCollection"'),
                             'Expected raw GeoJSON response')
 
+            feature = next(self.client.iter_features(typename))
+
+            self.assertEqual(feature['type'], 'Feature',
+                             'Expected GeoJSON feature')
+
     def test_get_data(self):
         """test get data handling"""
 
         dataset = 'totalozone'
-        bad_bbox = [42, -52, 84]
 
-        self.assertRaises(ValueError, self.client.get_data,
-                          dataset, bbox=bad_bbox)
+        bad_kwargs = [
+            (ValueError, {'bbox': [42, -52, 84]}),
+            (ValueError, {'bbox': '-142,42,-53,84'}),
+            (ValueError, {'bbox': [-200, 42, -53, 84]}),
+            (ValueError, {'temporal': '2000-11-11/2001-10-30'}),
+            (ValueError, {'temporal': ['2000-11-11']}),
+            (ValueError, {'sort_order': 'bad'}),
+            (ValueError, {'variables': 'foo'}),
+            (ValueError, {'filters': {'platform_id': []}}),
+            (TypeError, {'foo': 'bar'})
+        ]
+
+        for exception, kwargs in bad_kwargs:
+            with self.subTest(**kwargs):
+                self.assertRaises(exception, self.client.get_data,
+                                  dataset, **kwargs)
+
+
+class StubClientTest(unittest.TestCase):
+    """Test suite for pywoudc.WoudcClient against a stub WFS"""
+
+    def test_get_data_pages(self):
+        """test page download and assembly"""
+
+        for maxfeatures in [5, 23, 50]:
+            with self.subTest(maxfeatures=maxfeatures):
+                session = StubSession()
+                client = stub_client(session, maxfeatures)
+                data = client.get_data('totalozone')
+
+                self.assertEqual(data['type'], 'FeatureCollection')
+                self.assertEqual(data['features'], FEATURES,
+                                 'Expected all features in order')
+
+                startindexes = sorted(int(q['startindex'])
+                                      for q in session.get_features())
+                self.assertEqual(startindexes,
+                                 list(range(0, 23, maxfeatures)),
+                                 'Expected each page requested once')
+
+    def test_get_data_hits(self):
+        """test page sizing from the resultType=hits count"""
+
+        for hits in [True, False, 'error']:
+            with self.subTest(hits=hits):
+                session = StubSession(hits=hits)
+                client = stub_client(session)
+                data = client.get_data('totalozone')
+
+                self.assertEqual(data['features'], FEATURES,
+                                 'Expected all features in order')
+
+                hits_requests = [q for url, q, headers in session.requests
+                                 if q.get('resultType') == 'hits']
+                self.assertEqual(len(hits_requests), 1,
+                                 'Expected a single hits request')
+
+                # without a count, pages are fetched until a short one
+                self.assertEqual(len(session.get_features()), 5,
+                                 'Expected no extra page requests')
+
+    def test_get_data_sort(self):
+        """test server-side sorting and merging of sorted pages"""
+
+        for server_sort in [True, False]:
+            for sort_order in ['asc', 'desc']:
+                with self.subTest(server_sort=server_sort,
+                                  sort_order=sort_order):
+                    session = StubSession(sort=server_sort)
+                    client = stub_client(session)
+                    data = client.get_data('totalozone', sortby='v',
+                                           sort_order=sort_order)
+
+                    expected = sorted(FEATURES,
+                                      key=lambda f: f['properties']['v'],
+                                      reverse=sort_order == 'desc')
+                    self.assertEqual(data['features'], expected,
+                                     'Expected features sorted by v')
+
+                    sortby = 'v D' if sort_order == 'desc' else 'v A'
+                    for query in session.get_features():
+                        self.assertEqual(query['sortBy'], sortby)
+
+    def test_get_data_filters(self):
+        """test attribute filters, with lists of values as OR"""
+
+        session = StubSession()
+        client = stub_client(session)
+        client.get_data('totalozone', filters={'platform_id': [7, 65],
+                                               'instrument_name': 'Brewer'})
+
+        filter_string = session.get_features()[0]['filter']
+        self.assertIn('Or>', filter_string, 'Expected OR of values')
+        for value in ['7', '65', 'Brewer']:
+            self.assertIn('>%s<' % value, filter_string)
+
+        session = StubSession()
+        client = stub_client(session)
+        client.get_data('totalozone', filters={'platform_id': [7]})
+
+        filter_string = session.get_features()[0]['filter']
+        self.assertNotIn('Or>', filter_string, 'Expected single value')
+        self.assertIn('>7<', filter_string)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow not installed')
+    def test_get_data_arrow(self):
+        """test pyarrow output backend"""
+
+        session = StubSession()
+        client = stub_client(session)
+        table = client.get_data('totalozone', bbox=[-142, 42, -53, 84],
+                                sortby='v', sort_order='desc',
+                                output_backend='arrow')
+
+        expected = sorted(FEATURES, key=lambda f: f['properties']['v'],
+                          reverse=True)
+        self.assertEqual(table.column('n').to_pylist(),
+                         [f['properties']['n'] for f in expected],
+                         'Expected all rows sorted by v')
+
+        for query in session.get_features():
+            self.assertEqual(query['outputFormat'], 'csv')
+            self.assertIn('BBOX', query['filter'],
+                          'Expected spatial filter on every page')
+
+    @unittest.skipIf(pandas is None, 'pandas not installed')
+    def test_get_data_dataframe(self):
+        """test pandas dataframe output"""
+
+        expected = sorted(FEATURES, key=lambda f: f['properties']['v'])
+
+        client = stub_client(StubSession())
+        dataframe = client.get_data('totalozone', sortby='v',
+                                    as_dataframe=True)
+
+        self.assertIsInstance(dataframe, pandas.DataFrame)
+        self.assertEqual(list(dataframe['n']),
+                         [f['properties']['n'] for f in expected])
+        self.assertEqual(list(dataframe['geometry']),
+                         [f['geometry'] for f in expected])
+
+        if pyarrow is not None:
+            dataframe = client.get_data('totalozone', sortby='v',
+                                        output_backend='arrow',
+                                        as_dataframe=True)
+
+            self.assertIsInstance(dataframe, pandas.DataFrame)
+            self.assertEqual(list(dataframe['n']),
+                             [f['properties']['n'] for f in expected])
+
+    def test_get_data_cache(self):
+        """test observations cache in cache_dir"""
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        session_a = StubSession()
+        client_a = stub_client(session_a, url='https://a.example/ows',
+                               cache=True, cache_dir=cache_dir)
+        session_b = StubSession(features=FEATURES[:3])
+        client_b = stub_client(session_b, url='https://b.example/ows',
+                               cache=True, cache_dir=cache_dir)
+
+        self.assertEqual(client_a.get_data('totalozone')['features'],
+                         FEATURES)
+        num_requests = len(session_a.requests)
+
+        self.assertEqual(client_a.get_data('totalozone')['features'],
+                         FEATURES, 'Expected cached observations')
+        self.assertEqual(len(session_a.requests), num_requests,
+                         'Expected no request for cached observations')
+
+        self.assertEqual(client_b.get_data('totalozone')['features'],
+                         FEATURES[:3],
+                         'Expected observations from its own server')
+        self.assertTrue(session_b.requests,
+                        'Expected no observations cached for another server')
+
+        data_dir = os.path.join(cache_dir, 'data')
+        self.assertEqual(os.stat(data_dir).st_mode & 0o777, 0o700,
+                         'Expected private cache directory')
+        for filename in os.listdir(data_dir):
+            with open(os.path.join(data_dir, filename), 'rb') as fh:
+                self.assertIn('features', json.loads(fh.read().decode()),
+                              'Expected GeoJSON cache file')
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow not installed')
+    def test_get_data_cache_arrow(self):
+        """test observations cache in cache_dir for the arrow backend"""
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        session = StubSession()
+        client = stub_client(session, cache=True, cache_dir=cache_dir)
+
+        table = client.get_data('totalozone', output_backend='arrow')
+        num_requests = len(session.requests)
+
+        self.assertTrue(client.get_data('totalozone',
+                                        output_backend='arrow').equals(table),
+                        'Expected cached table')
+        self.assertEqual(len(session.requests), num_requests,
+                         'Expected no request for cached observations')
+
+    def test_get_metadata_etag(self):
+        """test metadata cache in cache_dir, revalidated by ETag"""
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        def get_stations(url):
+            session = StubSession(etag='"v1"')
+            client = stub_client(session, url=url, cache=True,
+                                 cache_dir=cache_dir)
+            data = client.get_station_metadata()
+            return data, session.requests[0][2]
+
+        data, headers = get_stations('https://a.example/ows')
+        self.assertEqual(data['features'], FEATURES)
+        self.assertNotIn('If-None-Match', headers)
+
+        data, headers = get_stations('https://a.example/ows')
+        self.assertEqual(data['features'], FEATURES,
+                         'Expected cached metadata when not modified')
+        self.assertEqual(headers.get('If-None-Match'), '"v1"')
+
+        data, headers = get_stations('https://b.example/ows')
+        self.assertNotIn('If-None-Match', headers,
+                         'Expected no ETag from another server')
+
+    def test_iter_features(self):
+        """test iterating over features page by page"""
+
+        for maxfeatures in [5, 23, 50]:
+            with self.subTest(maxfeatures=maxfeatures):
+                session = StubSession()
+                client = stub_client(session, maxfeatures)
+
+                self.assertEqual(list(client.iter_features('stations')),
+                                 FEATURES, 'Expected all features in order')
+
+        session = StubSession()
+        client = stub_client(session)
+        features = client.iter_features('stations')
+
+        self.assertEqual(next(features), FEATURES[0])
+        features.close()
+        self.assertEqual(len(session.requests), 1,
+                         'Expected no request beyond the first page')
+
+    def test_session(self):
+        """test sessions are per client, connection pools shared"""
 
-        self.assertRaises(ValueError, self.client.get_data,
-                          dataset, bbox='-142,42,-53,84')
+        client_a = WoudcClient(url='https://a.example/ows', cache=False)
+        client_b = WoudcClient(url='https://b.example/ows', cache=False)
 
-        self.assertRaises(ValueError, self.client.get_data,
-                          dataset, temporal='2000-11-11/2001-10-30')
+        self.assertIsNot(client_a.session, client_b.session)
+        self.assertIs(client_a.session.get_adapter(client_a.url),
+                      client_b.session.get_adapter(client_b.url),
+                      'Expected shared connection pool')
 
-        self.assertRaises(ValueError, self.client.get_data,
-                          dataset, temporal=['2000-11-11'])
+        client_a.session.headers['Authorization'] = 'secret'
+        self.assertNotIn('Authorization', client_b.session.headers,
+                         'Expected no headers leaking across clients')
 
-        self.assertRaises(ValueError, self.client.get_data,
-                          dataset, sort_order='bad')
+    def test_get_data_bad_url(self):
+        """test request errors are not mistaken for empty results"""
 
-        self.assertRaises(ValueError, self.client.get_data,
-                          dataset, variables='foo')
+        client = WoudcClient(url='geo.woudc.org/ows', cache=False)
+
+        self.assertRaises(requests.exceptions.MissingSchema,
+                          client.get_data, 'totalozone')
+
+    def test_get_data_exception(self):
+        """test OWS exception responses"""
+
+        client = stub_client(StubSession(exception=True))
+
+        self.assertIsNone(client.get_data('totalozone'))
+
+        if pyarrow is not None:
+            self.assertIsNone(client.get_data('totalozone',
+                                              output_backend='arrow'))
+
+    @unittest.skipIf(pywoudc.CacheControlAdapter is None,
+                     'CacheControl not installed')
+    def test_session_no_filelock(self):
+        """test HTTP caching is skipped if FileCache is unavailable"""
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        error = ImportError('filelock not installed')
+        with mock.patch('pywoudc.FileCache', side_effect=error):
+            client = WoudcClient(cache_dir=cache_dir)
+
+        adapter = client.session.get_adapter(client.url)
+        self.assertNotIsInstance(adapter, pywoudc.CacheControlAdapter,
+                                 'Expected uncached HTTP adapter')
+
+    def test_get_data_empty(self):
+        """test query without results"""
+
+        client = stub_client(StubSession(features=[]))
+
+        data = client.get_data('totalozone')
+
+        self.assertEqual(data['features'], [])
+
+
+class UtilTest(unittest.TestCase):
+    """Test suite for pywoudc utility functions (no client needed)"""
 
     def test_date2string(self):
         """test date handling"""
@@ -176,6 +618,60 @@ class WoudcClientTest(unittest.TestCase):
                          '2011-11-30 12:12:12',
                          'Expected specific date string from datetime object')
 
+    def test_date2string_timezone(self):
+        """test aware datetimes are formatted in their own time zone"""
+
+        utc = datetime.timezone.utc
+        plus5 = datetime.timezone(datetime.timedelta(hours=5))
+
+        self.assertEqual(date2string(
+                         datetime.datetime(2000, 1, 1, 5, tzinfo=plus5)),
+                         '2000-01-01 05:00:00')
+
+        # the same instant as above
+        self.assertEqual(date2string(
+                         datetime.datetime(2000, 1, 1, 0, tzinfo=utc)),
+                         '2000-01-01 00:00:00')
+
+    def test_sortby(self):
+        """test WFS sortBy parameter"""
+
+        self.assertIsNone(_sortby(None))
+        self.assertEqual(_sortby('v'), 'v A')
+        self.assertEqual(_sortby('v', True), 'v D')
+
+    def test_pages_in_order(self):
+        """test detection of pages sorted by the server"""
+
+        def pages(*keys):
+            return [[(key, None) for key in page] for page in keys]
+
+        self.assertTrue(_pages_in_order(pages([1, 2], [2, 3], [], [5])))
+        self.assertFalse(_pages_in_order(pages([1, 4], [2, 3])))
+        self.assertTrue(_pages_in_order(pages([4, 3], [3, 1]), True))
+        self.assertFalse(_pages_in_order(pages([4, 2], [3, 1]), True))
+        self.assertTrue(_pages_in_order([]))
+
+    def test_iter_features(self):
+        """test GeoJSON feature parsing"""
+
+        payload = json.dumps({
+            'type': 'FeatureCollection',
+            'features': FEATURES
+        }).encode('utf-8')
+        chunks = [payload[i:i + 100] for i in range(0, len(payload), 100)]
+
+        for incremental in [False, True]:
+            self.assertEqual(list(_iter_features(chunks, incremental)),
+                             FEATURES, 'Expected all features')
+
+            self.assertEqual(list(_iter_features([b' ', b'\n'],
+                                                 incremental)), [],
+                             'Expected no features from blank response')
+
+            with self.assertRaises(ValueError):
+                list(_iter_features([b'<Exception'], incremental))
+
 
 if __name__ == '__main__':
     unittest.main()